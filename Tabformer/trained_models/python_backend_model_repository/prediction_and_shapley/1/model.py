@@ -5,41 +5,17 @@
 # international Copyright laws.
 
 import os
-import sys
-import subprocess
-
-
-def install_package(package, version=None):
-    """
-    Attempts to import `package`. If not installed, installs it using pip.
-    If `version` is provided, installs `package==version`.
-    """
-    try:
-        __import__(package)
-        print(f"'{package}' is already installed.")
-    except ImportError:
-        # Build the package spec depending on whether a specific version is supplied
-        package_spec = f"{package}=={version}" if version else package
-        print(f"Installing {package_spec} ...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package_spec])
-        print(f"Installation of {package_spec} finished!")
-
-
-install_package("torch", "2.6.0")
-install_package("torch-geometric", "2.6.0")
-install_package("xgboost", "2.1.4")
-install_package("captum", "0.7.0")
-
 
 import json
+from collections import OrderedDict
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 import xgboost as xgb
 
-from captum.attr import ShapleyValueSampling
 from torch_geometric.nn import SAGEConv
 
 # Triton Python backend utilities.
@@ -94,17 +70,32 @@ class GraphSAGE(torch.nn.Module):
 
     def forward(self, x, edge_index, return_hidden: bool = False):
 
-        embeddings = x.clone()
+        # SAGEConv does not mutate its input, so no defensive copy is needed.
+        embeddings = x
         for conv in self.convs:
             embeddings = conv(embeddings, edge_index)
             embeddings = F.relu(embeddings)
-            embeddings = F.dropout(
-                embeddings, p=self.dropout_prob, training=self.training
-            )
+            # Dropout is a no-op in eval mode but still dispatches a kernel;
+            # skip it entirely outside of training.
+            if self.training:
+                embeddings = F.dropout(
+                    embeddings, p=self.dropout_prob, training=True
+                )
+        # Under autocast the conv stack runs in reduced precision; widen the
+        # embeddings back to the input dtype so the raw features pass through
+        # to the output unquantized.
+        if embeddings.dtype != x.dtype:
+            embeddings = embeddings.to(x.dtype)
         if return_hidden:
             return torch.cat((x, embeddings), dim=1)
         else:
-            return self.fc(torch.cat((x, embeddings), dim=1))
+            # fc(cat(x, embeddings)) decomposed into two matmuls over the fc
+            # weight halves, so the (N, in + hidden) concat intermediate is
+            # never materialized.
+            weight = self.fc.weight
+            return F.linear(x, weight[:, : self.in_channels]) + F.linear(
+                embeddings, weight[:, self.in_channels:], self.fc.bias
+            )
 
 
 class TritonPythonModel:
@@ -148,6 +139,14 @@ class TritonPythonModel:
         self.shap_dtype = pb_utils.triton_string_to_numpy(
             shap_config["data_type"])
 
+        # Torch-side equivalents of the configured output dtypes, so results
+        # can be cast (if needed at all) on the GPU and handed to Triton
+        # without an extra host-side astype copy.
+        self.prediction_torch_dtype = torch.from_numpy(
+            np.empty(0, dtype=self.prediction_dtype)).dtype
+        self.shap_torch_dtype = torch.from_numpy(
+            np.empty(0, dtype=self.shap_dtype)).dtype
+
         self.device = torch.device("cuda")
         self.model = GraphSAGE(
             self.in_channels, self.hidden_channels, self.out_channels, self.n_layers
@@ -161,81 +160,356 @@ class TritonPythonModel:
         self.model.load_state_dict(state_dict)
         self.model.to(self.device)
         self.model.eval()
+        # Compile the forward with TorchScript: the conv loop runs hundreds
+        # of times per Shapley request, and scripting takes the Python
+        # dispatch out of each SAGEConv/ReLU step.
+        self.model = torch.jit.script(self.model)
 
         self.bst = xgb.Booster()
         self.bst.load_model(
             os.path.join(
                 current_directory,
                 self.xgb_model_filename))
-        self.bst.set_param({"tree_method": "hist", "device": "cuda"})
+        # Pin prediction to a single host thread: Triton may fan out several
+        # Python backend workers per pod, and letting each spin up an OpenMP
+        # pool oversubscribes the cores. device=cuda already selects GPU
+        # prediction.
+        self.bst.set_param({
+            "tree_method": "hist",
+            "device": "cuda",
+            "nthread": 1,
+        })
+
+        # CUDA Graphs captured per (num_nodes, num_edges) shape. The Shapley
+        # sampler replays the same tiny forward 128 times per request, so the
+        # per-kernel launch overhead dominates; replaying a captured graph
+        # removes it. Request shapes vary freely ([-1, 75] node features,
+        # [2, -1] edges) and every retained graph pins a private memory pool,
+        # so the cache is a bounded LRU: evicting an entry drops the last
+        # reference to the graph and frees its pool.
+        self._graph_cache = OrderedDict()
+        self._graph_cache_limit = 32
+
+        # Pinned host staging buffers keyed by (shape, dtype). Uploading from
+        # pageable numpy memory forces the driver to stage through its own
+        # pinned buffer; copying into a reusable pinned tensor first gets the
+        # full PCIe bandwidth and lets the H2D copy run asynchronously.
+        # Bounded like the graph cache so variable shapes cannot grow it
+        # without limit.
+        self._pinned_buffers = OrderedDict()
+        self._pinned_buffers_limit = 64
+
+        # Shapley accumulators keyed by shape, reused across requests instead
+        # of allocating a fresh (num_nodes, num_features) tensor each time;
+        # bounded like the caches above.
+        self._attr_buffers = OrderedDict()
+        self._attr_buffers_limit = 64
+
+        # Constants reused on every request: the number of Shapley
+        # permutations and the zero attribution block returned when SHAP is
+        # not requested, allocated once instead of per request.
+        self.n_samples = 128
+        self.zero_attributions = torch.zeros(
+            (1, self.in_channels), dtype=self.shap_torch_dtype)
+
+    def _to_device(self, array):
+        """Upload a numpy array through a cached pinned staging buffer."""
+        host = torch.from_numpy(array)
+        key = (host.shape, host.dtype)
+        pinned = self._pinned_buffers.get(key)
+        if pinned is None:
+            pinned = torch.empty_like(host, pin_memory=True)
+            self._pinned_buffers[key] = pinned
+            while len(self._pinned_buffers) > self._pinned_buffers_limit:
+                self._pinned_buffers.popitem(last=False)
+        else:
+            self._pinned_buffers.move_to_end(key)
+        pinned.copy_(host)
+        return pinned.to(self.device, non_blocking=True)
+
+    def _predict(self, embeddings):
+        """
+        Run XGBoost over CUDA embeddings without leaving the device.
+
+        inplace_predict consumes the tensor directly through
+        __cuda_array_interface__ and returns a device array, wrapped with
+        torch.from_dlpack so no host round trip occurs. XGBoost emits that
+        array as a cupy ndarray, so cupy must be available at serving time
+        (it is installed alongside the other pinned dependencies by the
+        inference deployment). The call runs on the default stream so the
+        embedding producer and XGBoost's own stream stay implicitly
+        ordered.
+        """
+        return torch.from_dlpack(
+            self.bst.inplace_predict(embeddings.float()))
+
+    def _graphed_forward(self, x_gpu, edge_index_gpu):
+        """
+        Run the embedding forward through a CUDA Graph cached by input shape.
+
+        The first call for a given (num_nodes, num_edges) pair warms the model
+        up on a side stream and captures the forward into a graph with static
+        input/output buffers; subsequent calls only copy the inputs into the
+        static buffers and replay the graph.
+        """
+        key = (x_gpu.shape[0], edge_index_gpu.shape[1])
+        entry = self._graph_cache.get(key)
+        if entry is None:
+            # The input buffer stays fp32: the raw features flow past the GNN
+            # into XGBoost, whose trees split on thresholds learned from fp32
+            # data, so only the conv stack (via autocast below) may run
+            # narrow.
+            static_x = x_gpu.clone()
+            static_edge = edge_index_gpu.clone()
+
+            # Warm up on a side stream so capture starts from a quiet state.
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream), torch.no_grad(), \
+                    torch.autocast("cuda", dtype=torch.bfloat16):
+                for _ in range(3):
+                    self.model(static_x, static_edge, True)
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), torch.no_grad(), \
+                    torch.autocast("cuda", dtype=torch.bfloat16):
+                static_out = self.model(static_x, static_edge, True)
+
+            entry = (graph, static_x, static_edge, static_out)
+            self._graph_cache[key] = entry
+            while len(self._graph_cache) > self._graph_cache_limit:
+                self._graph_cache.popitem(last=False)
+        else:
+            self._graph_cache.move_to_end(key)
+
+        graph, static_x, static_edge, static_out = entry
+        static_x.copy_(x_gpu, non_blocking=True)
+        static_edge.copy_(edge_index_gpu, non_blocking=True)
+        graph.replay()
+        return static_out
+
+    def _batched_shapley(self, x_gpu, edge_index_gpu, feature_mask, full_pred,
+                         n_samples=128):
+        """
+        Estimate Shapley values by permutation sampling, batched on the GPU.
+
+        For each sampled permutation of the feature groups (defined by
+        `feature_mask`), the intermediate "prefix" states — baseline with the
+        first s groups switched on — are stacked along the node dimension and
+        evaluated in a single model forward over a block-diagonal graph,
+        instead of one forward per masked sample. The marginal contribution
+        of each group is the difference between consecutive prefix
+        predictions, averaged over permutations.
+
+        Only the strict prefixes (s = 1..G-1) depend on the permutation: the
+        empty prefix is the all-zeros baseline, evaluated once here, and the
+        full prefix is the unmasked input, whose prediction the caller
+        already has and passes in as `full_pred`.
+
+        Returns a (num_nodes, num_features) tensor of attributions.
+        """
+        num_nodes, num_features = x_gpu.shape
+        num_edges = edge_index_gpu.shape[1]
+
+        groups, feature_to_group = torch.unique(
+            feature_mask, return_inverse=True)
+        num_groups = groups.shape[0]
+        num_variants = num_groups - 1
+
+        # group_members[g, f] is True when feature f belongs to group g.
+        group_members = feature_mask.unsqueeze(0) == groups.unsqueeze(1)
+
+        # The all-masked endpoint is permutation-independent; evaluate it
+        # once per request rather than inside every permutation batch.
+        baseline_pred = self._predict(
+            self._graphed_forward(torch.zeros_like(x_gpu), edge_index_gpu))
+
+        # Block-diagonal edge_index for the stacked variants: tile the edges
+        # and shift each copy by its variant's node offset.
+        offsets = (
+            torch.arange(num_variants, device=x_gpu.device) * num_nodes
+        )
+        edge_index_batch = (
+            edge_index_gpu.unsqueeze(0) + offsets.view(-1, 1, 1)
+        ).permute(1, 0, 2).reshape(2, num_variants * num_edges)
+
+        # The result is copied to host by the caller before the next request
+        # runs, so the accumulator can be recycled per shape.
+        attributions = self._attr_buffers.get((num_nodes, num_features))
+        if attributions is None:
+            attributions = torch.zeros(
+                (num_nodes, num_features), device=x_gpu.device)
+            self._attr_buffers[(num_nodes, num_features)] = attributions
+            while len(self._attr_buffers) > self._attr_buffers_limit:
+                self._attr_buffers.popitem(last=False)
+        else:
+            self._attr_buffers.move_to_end((num_nodes, num_features))
+            attributions.zero_()
+
+        for _ in range(n_samples):
+            perm = torch.randperm(num_groups, device=x_gpu.device)
+
+            # prefix[s, f] is True when feature f is active after the first
+            # s+1 groups of the permutation have been added to the baseline;
+            # the last (full) prefix is dropped since full_pred covers it.
+            prefix = torch.cumsum(
+                group_members[perm].to(x_gpu.dtype), dim=0)[:-1]
+
+            # Baseline is all-zeros, so masking is multiplication.
+            x_batch = (
+                x_gpu.unsqueeze(0) * prefix.unsqueeze(1)
+            ).reshape(num_variants * num_nodes, num_features)
+
+            # The predictions come back as a device array, so the whole
+            # permutation stays on the GPU with no host synchronization.
+            embeddings = self._graphed_forward(x_batch, edge_index_batch)
+            preds = torch.cat((
+                baseline_pred.unsqueeze(0),
+                self._predict(embeddings).reshape(num_variants, num_nodes),
+                full_pred.unsqueeze(0),
+            ))
+
+            # Marginal contribution of the group added at each step, scattered
+            # back onto the features of that group.
+            marginals = preds[1:] - preds[:-1]
+            contributions = torch.zeros_like(marginals)
+            contributions[perm] = marginals
+            attributions += contributions[feature_to_group].T
+
+        return attributions.div_(n_samples)
 
     def execute(self, requests):
         responses = []
-        for request in requests:
-
-            node_features_numpy = pb_utils.get_input_tensor_by_name(
-                request, "NODE_FEATURES"
-            ).as_numpy()
-            edge_index_numpy = pb_utils.get_input_tensor_by_name(
-                request, "EDGE_INDEX"
-            ).as_numpy()
-            compute_shap_numpy = pb_utils.get_input_tensor_by_name(
-                request, "COMPUTE_SHAP"
-            ).as_numpy()
-            feature_mask_numpy = pb_utils.get_input_tensor_by_name(
-                request, "FEATURE_MASK"
-            ).as_numpy()
-
-            embeddings = self.model(
-                torch.as_tensor(node_features_numpy, device=self.device),
-                torch.as_tensor(edge_index_numpy, device=self.device),
-                True,
-            )
-            y_pred_prob = self.bst.predict(
-                xgb.DMatrix(embeddings.detach()))[:, None]
-            if compute_shap_numpy[0]:
-
-                def forward_function(node_x_tensor):
-                    embeddings = self.model(
-                        node_x_tensor.to(self.device),
-                        torch.as_tensor(edge_index_numpy, device=self.device),
-                        True,
-                    )
-                    return torch.tensor(
-                        self.bst.predict(xgb.DMatrix(embeddings.detach()))
+        # Autograd bookkeeping is pure overhead here: inference_mode keeps
+        # the hundreds of Shapley forwards per request from building graphs.
+        with torch.inference_mode():
+            # Gather every request's inputs on the host first so the whole
+            # Triton batch runs through a single stacked forward instead of
+            # one small forward per request.
+            node_features_list = []
+            edge_index_list = []
+            compute_shap_flags = []
+            feature_mask_list = []
+            for request in requests:
+                node_features_list.append(
+                    pb_utils.get_input_tensor_by_name(
+                        request, "NODE_FEATURES"
+                    ).as_numpy()
+                )
+                edge_index_list.append(
+                    pb_utils.get_input_tensor_by_name(
+                        request, "EDGE_INDEX"
+                    ).as_numpy()
+                )
+                compute_shap_flags.append(
+                    bool(
+                        pb_utils.get_input_tensor_by_name(
+                            request, "COMPUTE_SHAP"
+                        ).as_numpy()[0]
                     )
-
-                shapley_sampler = ShapleyValueSampling(forward_function)
-                x_input = torch.as_tensor(
-                    node_features_numpy).to(torch.float32)
-                baseline = torch.zeros_like(x_input)
-
-                # Compute Shapley attributions
-                attributions = shapley_sampler.attribute(
-                    x_input,
-                    baselines=baseline,
-                    feature_mask=torch.tensor(
-                        feature_mask_numpy).to(torch.int32),
-                    n_samples=128,
                 )
-            else:
-                attributions = torch.zeros((1, self.in_channels))
-
-            # Prepare response
-
-            inference_response = pb_utils.InferenceResponse(
-                output_tensors=[
-                    pb_utils.Tensor(
-                        "PREDICTION",
-                        y_pred_prob.astype(self.prediction_dtype),
-                    ),
-                    pb_utils.Tensor(
-                        "SHAP_VALUES",
-                        attributions.numpy().astype(self.shap_dtype),
-                    ),
-                ]
+                feature_mask_list.append(
+                    pb_utils.get_input_tensor_by_name(
+                        request, "FEATURE_MASK"
+                    ).as_numpy()
+                )
+
+            # Per-request node/edge counts and their cumulative offsets,
+            # computed once as plain arrays instead of running Python
+            # accumulators in the loops below.
+            node_counts = np.array(
+                [x.shape[0] for x in node_features_list], dtype=np.int64)
+            edge_counts = np.array(
+                [e.shape[1] for e in edge_index_list], dtype=np.int64)
+            node_offsets = np.concatenate(([0], np.cumsum(node_counts)))
+            edge_offsets = np.concatenate(([0], np.cumsum(edge_counts)))
+
+            # Block-diagonalize: stack the node features and shift each
+            # request's edges by its cumulative node offset so the disjoint
+            # graphs form one big graph.
+            shifted_edges = [
+                edges + offset
+                for edges, offset in zip(edge_index_list, node_offsets)
+            ]
+
+            node_features_gpu = self._to_device(
+                np.concatenate(node_features_list, axis=0))
+            # Edge indices arrive as int64, but int32 comfortably covers the
+            # node counts seen here; uploading them narrow halves the PCIe
+            # bytes, and widening back on the device is cheap by comparison.
+            edge_index_gpu = self._to_device(
+                np.ascontiguousarray(
+                    np.concatenate(shifted_edges, axis=1), dtype=np.int32)
+            ).to(torch.int64)
+
+            embeddings = self._graphed_forward(
+                node_features_gpu,
+                edge_index_gpu,
             )
-            responses.append(inference_response)
+            y_pred_gpu = self._predict(embeddings)
+            y_pred_all = y_pred_gpu.to(
+                self.prediction_torch_dtype).cpu().numpy()
+
+            # The stacked forward above already covers the no-SHAP requests
+            # entirely, so only the subgroup that asked for attributions runs
+            # any further GPU work; everyone else shares the cached zero
+            # block.
+            shap_values = [self.zero_attributions.numpy()] * len(requests)
+            for i in np.flatnonzero(compute_shap_flags):
+                node_start = node_offsets[i]
+                edge_start = edge_offsets[i]
+                num_nodes = node_counts[i]
+                num_edges = edge_counts[i]
+
+                # Normalize on the host so the upload is a single zero-copy
+                # from_numpy wrap instead of an intermediate tensor plus a
+                # cast.
+                feature_mask_tensor = self._to_device(
+                    np.ascontiguousarray(
+                        feature_mask_list[i], dtype=np.int32)
+                )
+
+                # Slice this request's subgraph back out of the batch and
+                # undo its node offset.
+                x_request = node_features_gpu[
+                    node_start:node_start + num_nodes]
+                edge_index_request = (
+                    edge_index_gpu[:, edge_start:edge_start + num_edges]
+                    - node_start
+                )
+
+                # Compute Shapley attributions, reusing this request's
+                # unmasked prediction as the full-coalition endpoint. The
+                # download happens here because the estimator recycles its
+                # accumulator between calls.
+                shap_values[i] = self._batched_shapley(
+                    x_request.to(torch.float32),
+                    edge_index_request,
+                    feature_mask_tensor,
+                    y_pred_gpu[node_start:node_start + num_nodes],
+                    n_samples=self.n_samples,
+                ).to(self.shap_torch_dtype).cpu().numpy()
+
+            # Prepare responses
+
+            for i in range(len(requests)):
+                node_start = node_offsets[i]
+                y_pred_prob = y_pred_all[
+                    node_start:node_start + node_counts[i]][:, None]
+                inference_response = pb_utils.InferenceResponse(
+                    output_tensors=[
+                        pb_utils.Tensor(
+                            "PREDICTION",
+                            y_pred_prob,
+                        ),
+                        pb_utils.Tensor(
+                            "SHAP_VALUES",
+                            shap_values[i],
+                        ),
+                    ]
+                )
+                responses.append(inference_response)
         return responses
 
     def finalize(self):